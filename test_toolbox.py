@@ -1,4 +1,6 @@
+import os
 import pytest
+import shutil
 import subprocess
 import sys
 from pathlib import Path
@@ -24,3 +26,156 @@ def test_syntax_valid():
     with open(tool_path, "r") as f:
         source = f.read()
     compile(source, tool_path, "exec")
+
+def test_parse_depfile(tmp_path):
+    import toolbox
+    d = tmp_path / "ping.o.d"
+    d.write_text(
+        "/b/obj/ping.o: /t/ping.c /t/my\\ dir/a.h \\\n"
+        " /t/b.h\n"
+        "/t/my\\ dir/a.h:\n"
+        "/t/b.h:\n"
+    )
+    assert toolbox.parse_depfile(d) == ["/t/ping.c", "/t/my dir/a.h", "/t/b.h"]
+
+
+def test_failed_build_invalidates_dispatcher_key(tmp_path, monkeypatch):
+    import toolbox
+    monkeypatch.setattr(toolbox, "BUILD", tmp_path / "build")
+    monkeypatch.setattr(toolbox, "TOOLS", tmp_path / "tools")
+    monkeypatch.setattr(toolbox, "find_ldflags", lambda *args: [])
+    monkeypatch.setattr(toolbox.subprocess, "check_call", lambda *args, **kw: None)
+    toolbox.BUILD.mkdir()
+    compiled = []
+
+    def fake_compile(cc, jobs, generated=()):
+        compiled[:] = [src.name for src, _ in jobs]
+        for _, obj in jobs:
+            obj.touch()
+        return {}
+
+    def failing_compile(cc, jobs, generated=()):
+        fake_compile(cc, jobs, generated)
+        raise toolbox.subprocess.CalledProcessError(1, "cc")
+
+    out = toolbox.BUILD / "toolbox"
+    monkeypatch.setattr(toolbox, "compile_objects", fake_compile)
+    toolbox.build_objects([sys.executable], ["ping"], "ping table", out, {})
+    assert "main.c" in compiled
+
+    # main.o is rebuilt for {ping, bad} but a tool TU fails.
+    monkeypatch.setattr(toolbox, "compile_objects", failing_compile)
+    with pytest.raises(toolbox.subprocess.CalledProcessError):
+        toolbox.build_objects([sys.executable], ["bad", "ping"], "bad+ping table", out, {})
+
+    # Back to {ping}: the stale main.o must not be reused.
+    monkeypatch.setattr(toolbox, "compile_objects", fake_compile)
+    toolbox.build_objects([sys.executable], ["ping"], "ping table", out, {})
+    assert "main.c" in compiled
+
+
+def test_manifest_up_to_date(tmp_path, monkeypatch):
+    import toolbox
+    monkeypatch.setattr(toolbox, "TOOLS", tmp_path)
+    src = tmp_path / "ping.c"
+    hdr = tmp_path / "ping.h"
+    out = tmp_path / "toolbox"
+    src.write_text("int ping_main;\n")
+    hdr.write_text("#define A 1\n")
+    out.touch()
+    cc = [sys.executable]
+    deps = {"ping.o": [str(src), str(hdr)]}
+
+    prior = toolbox._current_state(cc, ["ping"], deps, {})
+    assert toolbox._up_to_date(out, toolbox._current_state(cc, ["ping"], deps, prior), prior)
+
+    # Touching without changing content is still up to date.
+    st = src.stat()
+    os.utime(src, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    state = toolbox._current_state(cc, ["ping"], deps, prior)
+    assert state != prior
+    assert toolbox._up_to_date(out, state, prior)
+
+    hdr.write_text("#define A 2\n")
+    assert not toolbox._up_to_date(out, toolbox._current_state(cc, ["ping"], deps, prior), prior)
+    hdr.write_text("#define A 1\n")
+
+    src.write_text("int ping_main = 1;\n")
+    assert not toolbox._up_to_date(out, toolbox._current_state(cc, ["ping"], deps, prior), prior)
+    src.write_text("int ping_main;\n")
+
+    out.unlink()
+    assert not toolbox._up_to_date(out, toolbox._current_state(cc, ["ping"], deps, prior), prior)
+
+
+def test_object_cache_checks_deps(tmp_path, monkeypatch):
+    import toolbox
+    monkeypatch.setattr(toolbox, "BUILD", tmp_path)
+    hdr = tmp_path / "ping.h"
+    hdr.write_text("#define A 1\n")
+    obj = tmp_path / "ping.o"
+    obj.write_bytes(b"object")
+    toolbox._cache_store("k", obj, [str(hdr)])
+
+    fetched = tmp_path / "fetched.o"
+    assert toolbox._cache_fetch("k", fetched) == [str(hdr)]
+    assert fetched.read_bytes() == b"object"
+
+    hdr.write_text("#define A 2\n")
+    assert toolbox._cache_fetch("k", tmp_path / "miss.o") is None
+    assert toolbox._cache_fetch("missing", tmp_path / "miss.o") is None
+
+
+TOOLBOX = Path(__file__).resolve().parent / "toolbox.py"
+needs_cc = pytest.mark.skipif(
+    not (shutil.which("gcc") or shutil.which("clang")), reason="no C compiler"
+)
+
+
+def run_toolbox(home, *args, **env):
+    return subprocess.run(
+        [sys.executable, str(TOOLBOX), *args],
+        env={**os.environ, "HOME": str(home), "TOOLBOX_VENV_ACTIVE": "1", **env},
+        capture_output=True, text=True,
+    )
+
+
+@needs_cc
+def test_per_tu_build_keeps_tool_feature_macros(tmp_path):
+    assert run_toolbox(tmp_path, "create", "ping").returncode == 0
+    tools = tmp_path / ".tools" / "toolbox" / "tools"
+    (tools / "gnu.c").write_text(
+        "#define _GNU_SOURCE\n"
+        "#include <stdio.h>\n"
+        "#include <stdlib.h>\n"
+        "int gnu_main(int argc, char **argv) {\n"
+        "    char *s;\n"
+        "    (void)argc; (void)argv;\n"
+        "    if (asprintf(&s, \"gnu %d\", 42) < 0) return 1;\n"
+        "    puts(s);\n"
+        "    free(s);\n"
+        "    return 0;\n"
+        "}\n"
+    )
+    result = run_toolbox(tmp_path, "build", TOOLBOX_AMALGAM="0")
+    assert result.returncode == 0, result.stderr
+    gnu = tmp_path / ".tools" / "toolbox" / "bin" / "gnu"
+    assert subprocess.run([str(gnu)], capture_output=True, text=True).stdout == "gnu 42\n"
+
+
+@needs_cc
+def test_auto_mode_falls_back_to_per_tu_build(tmp_path):
+    tools = tmp_path / ".tools" / "toolbox" / "tools"
+    for name in ("ping", "pong"):
+        assert run_toolbox(tmp_path, "create", name).returncode == 0
+        # Identical static helpers clash once the tools share one TU.
+        with open(tools / f"{name}.c", "a") as f:
+            f.write(f"static int helper(void) {{ return 0; }}\n"
+                    f"int {name}_helper(void) {{ return helper(); }}\n")
+    result = run_toolbox(tmp_path, "build", TOOLBOX_AMALGAM="auto")
+    assert result.returncode == 0, result.stderr
+    assert "compiling per TU" in result.stdout
+    bin_dir = tmp_path / ".tools" / "toolbox" / "bin"
+    for name in ("ping", "pong"):
+        run = subprocess.run([str(bin_dir / name)], capture_output=True, text=True)
+        assert run.stdout == f"Running {name}\n"
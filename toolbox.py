@@ -11,12 +11,16 @@ from __future__ import annotations
 
 import os
 import sys
+import collections
+import functools
+import hashlib
+import io
+import json
 import subprocess
 import shutil
 import re
-import tempfile
 from pathlib import Path
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 
 
 # =============================
@@ -31,23 +35,50 @@ VENV = ROOT / "venv"
 TOOLS = ROOT / "tools"
 BUILD = ROOT / "build"
 BIN = ROOT / "bin"
+MANIFEST = BUILD / ".manifest.json"
+
+# Below this many tools, one amalgamated TU beats per-TU process startup.
+AMALGAM_MAX_TOOLS = 8
 
 TOOL_RE = re.compile(r"^[a-z][a-z0-9_]*$")
 
 CFLAGS = [
     "-Wall", "-Wextra", "-Werror",
     "-O2",
+    "-pipe",
     "-fstack-protector-strong",
     "-D_FORTIFY_SOURCE=2",
     "-fPIE",
 ]
 LDFLAGS = ["-pie"]
 
+# System headers precompiled once and force-included into the generated
+# dispatcher. Tool sources never get them: a tool may define feature-test
+# macros such as _GNU_SOURCE before its own includes.
+PCH_HEADERS = ("stdio.h", "string.h", "libgen.h")
+
 
 # =============================
 # Venv Bootstrap
 # =============================
 
+def _venv_version() -> Optional[Tuple[int, int]]:
+    """Return the (major, minor) Python version recorded in pyvenv.cfg."""
+    try:
+        cfg = (VENV / "pyvenv.cfg").read_text()
+    except OSError:
+        return None
+    for line in cfg.splitlines():
+        key, _, value = line.partition("=")
+        if key.strip() in ("version", "version_info"):
+            parts = value.strip().split(".")
+            try:
+                return int(parts[0]), int(parts[1])
+            except (IndexError, ValueError):
+                return None
+    return None
+
+
 def ensure_venv():
     if os.environ.get("TOOLBOX_VENV_ACTIVE") == "1":
         return
@@ -55,12 +86,27 @@ def ensure_venv():
     ROOT.mkdir(parents=True, exist_ok=True)
     if not VENV.exists():
         print("[*] Creating Python venv:", VENV)
-        subprocess.check_call([sys.executable, "-m", "venv", str(VENV)])
+        # No packages are installed into the venv, so skip bootstrapping pip.
+        import venv
+        venv.create(str(VENV), with_pip=False, symlinks=True, clear=False)
 
     python = VENV / "bin" / "python"
     if not python.exists():
         sys.exit("[!] venv python missing")
 
+    # Same interpreter version: activate in-process instead of re-exec'ing.
+    if _venv_version() == sys.version_info[:2]:
+        import site
+        site_packages = (
+            VENV / "lib" / f"python{sys.version_info[0]}.{sys.version_info[1]}"
+            / "site-packages"
+        )
+        sys.path.insert(0, str(site_packages))
+        sys.prefix = sys.exec_prefix = str(VENV)
+        site.addsitedir(str(site_packages))
+        os.environ["TOOLBOX_VENV_ACTIVE"] = "1"
+        return
+
     env = os.environ.copy()
     env["TOOLBOX_VENV_ACTIVE"] = "1"
 
@@ -85,14 +131,68 @@ def ensure_dirs():
         d.mkdir(parents=True, exist_ok=True)
 
 
-def find_cc() -> str:
+@functools.lru_cache(maxsize=1)
+def find_cc() -> List[str]:
+    """Return the compiler command, prefixed with ccache when available."""
+    cache = ROOT / ".cc_path"
+    try:
+        cached = cache.read_text().split("\n")
+    except OSError:
+        cached = []
+    if cached and all(os.access(p, os.X_OK) for p in cached):
+        return cached
+
     for cc in ("gcc", "clang"):
         path = shutil.which(cc)
         if path:
-            return path
+            ccache = shutil.which("ccache")
+            cmd = [ccache, path] if ccache else [path]
+            atomic_write(cache, "\n".join(cmd))
+            return cmd
     die("No C compiler found (gcc/clang)")
 
 
+@functools.lru_cache(maxsize=1)
+def find_ldflags(cc: str) -> List[str]:
+    """Return LDFLAGS, switching the link to lld when cc can drive it.
+
+    The probe result is kept in build/.ldflags.json, keyed on the compiler
+    and ld.lld builds, so no-op builds do not pay for a test link. Set
+    TOOLBOX_LLD=0 to keep the default linker.
+    """
+    lld = shutil.which("ld.lld")
+    if os.environ.get("TOOLBOX_LLD") == "0" or not lld:
+        return list(LDFLAGS)
+
+    st = os.stat(lld)
+    key = repr((compiler_id([cc]), lld, st.st_mtime_ns, st.st_size, LDFLAGS))
+    cache = BUILD / ".ldflags.json"
+    try:
+        cached = json.loads(cache.read_text())
+        if cached["key"] == key:
+            return cached["flags"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    # Older drivers (e.g. gcc < 9) reject -fuse-ld=lld; try a trivial link.
+    flags = [*LDFLAGS, "-fuse-ld=lld"]
+    probe = BUILD / f".ldprobe.{os.getpid()}"
+    try:
+        ok = subprocess.run(
+            [cc, "-fPIE", "-x", "c", "-", "-o", str(probe), *flags],
+            input=b"int main(void) { return 0; }\n",
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        ).returncode == 0
+    except OSError:
+        ok = False
+    finally:
+        if probe.exists():
+            probe.unlink()
+    flags = flags if ok else list(LDFLAGS)
+    atomic_write(cache, json.dumps({"key": key, "flags": flags}))
+    return flags
+
+
 def validate_tool(name: str) -> str:
     if not TOOL_RE.match(name):
         die("Invalid tool name (lowercase, start with letter)")
@@ -100,14 +200,263 @@ def validate_tool(name: str) -> str:
 
 
 def atomic_write(path: Path, data: str):
-    with tempfile.NamedTemporaryFile("w", delete=False, dir=path.parent) as f:
-        f.write(data)
-        tmp = f.name
+    tmp = f"{path}.tmp.{os.getpid()}"
+    buf = memoryview(data.encode())
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        while buf:
+            buf = buf[os.write(fd, buf):]
+    except BaseException:
+        os.close(fd)
+        os.unlink(tmp)
+        raise
+    os.close(fd)
     os.replace(tmp, path)
 
 
 def list_tools() -> List[str]:
-    return sorted(p.stem for p in TOOLS.glob("*.c"))
+    match = TOOL_RE.match
+    return sorted(p.stem for p in TOOLS.glob("*.c") if match(p.stem))
+
+
+def file_sha256(path: Path) -> str:
+    with open(path, "rb") as f:
+        if hasattr(hashlib, "file_digest"):  # Python 3.11+
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        h = hashlib.sha256()
+        for chunk in iter(lambda: f.read(65536), b""):
+            h.update(chunk)
+        return h.hexdigest()
+
+
+def parse_depfile(path: Path) -> List[str]:
+    """Return the prerequisites of the first rule in a make-style .d file."""
+    rule = path.read_text().replace("\\\n", " ").split("\n", 1)[0]
+    deps = rule.partition(":")[2].strip()
+    return [d.replace("\\ ", " ") for d in re.split(r"(?<!\\)\s+", deps) if d]
+
+
+def _depfile(obj: Path) -> Path:
+    return obj.with_name(f"{obj.name}.d")
+
+
+def _compile_cmd(cc: List[str], cflags: List[str], src: Path, obj: Path) -> List[str]:
+    return [*cc, *cflags, "-MMD", "-MP", "-MF", str(_depfile(obj)),
+            "-c", str(src), "-o", str(obj)]
+
+
+def compiler_id(cc: List[str]) -> Tuple[List[str], int, int]:
+    """Identify the installed compiler build by path, mtime and size.
+
+    Lets keys notice an in-place compiler upgrade at the cost of one stat.
+    """
+    st = os.stat(cc[-1])
+    return cc, st.st_mtime_ns, st.st_size
+
+
+def _cache_key(cc: List[str], cflags: List[str], src: Path) -> str:
+    return hashlib.sha256(
+        (file_sha256(src) + repr((compiler_id(cc), cflags, PCH_HEADERS))).encode()
+    ).hexdigest()
+
+
+def _ensure_pch(cc: List[str]) -> List[str]:
+    """Precompile the dispatcher's system headers; return the flags to use it.
+
+    The header is rebuilt only when the compiler binary, CFLAGS or header
+    list change. Returns no flags if precompilation fails.
+    """
+    header = BUILD / "common.h"
+    clang = "clang" in Path(cc[-1]).name
+    pch = header.with_name(header.name + (".pch" if clang else ".gch"))
+    key_path = header.with_name(header.name + ".key")
+    # An in-place compiler upgrade regenerates the PCH instead of reusing
+    # an incompatible one.
+    key = hashlib.sha256(
+        repr((compiler_id(cc), CFLAGS, PCH_HEADERS)).encode()
+    ).hexdigest()
+
+    try:
+        fresh = key_path.read_text() == key and pch.exists()
+    except OSError:
+        fresh = False
+    if not fresh:
+        atomic_write(header, "".join(f"#include <{h}>\n" for h in PCH_HEADERS))
+        rc = subprocess.call(
+            [cc[-1], *CFLAGS, "-x", "c-header", str(header), "-o", str(pch)]
+        )
+        if rc:
+            return []
+        atomic_write(key_path, key)
+
+    flags = ["-include", str(header)]
+    if len(cc) > 1 and not clang:
+        flags.append("-fpch-preprocess")
+    return flags
+
+
+def _ccache_env(ccache: str) -> Dict[str, str]:
+    """Environment for ccache compiles that use the precompiled header.
+
+    CCACHE_SLOPPINESS overrides ccache.conf, so the user's configured
+    sloppiness is kept and only the PCH-related options are added.
+    """
+    current = os.environ.get("CCACHE_SLOPPINESS")
+    if current is None:
+        try:
+            current = subprocess.run(
+                [ccache, "--get-config", "sloppiness"],
+                capture_output=True, text=True, check=True,
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            current = ""
+    opts = [o for o in current.split(",") if o.strip()]
+    opts += [o for o in ("pch_defines", "time_macros") if o not in opts]
+    return {**os.environ, "CCACHE_SLOPPINESS": ",".join(opts)}
+
+
+def _cache_fetch(key: str, obj: Path) -> Optional[List[str]]:
+    """Copy build/cache/<key>.o to obj if its recorded deps still match."""
+    cached = BUILD / "cache" / f"{key}.o"
+    try:
+        deps = json.loads((BUILD / "cache" / f"{key}.json").read_text())
+        if cached.exists() and all(file_sha256(Path(d)) == h for d, h in deps.items()):
+            shutil.copyfile(cached, obj)
+            return list(deps)
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _cache_store(key: str, obj: Path, deps: List[str]):
+    cache_dir = BUILD / "cache"
+    cache_dir.mkdir(exist_ok=True)
+    cached = cache_dir / f"{key}.o"
+    tmp = cached.with_suffix(f".{os.getpid()}.tmp")
+    shutil.copyfile(obj, tmp)
+    os.replace(tmp, cached)
+    atomic_write(cache_dir / f"{key}.json",
+                 json.dumps({d: file_sha256(Path(d)) for d in deps}))
+
+
+def _prune_cache(keep: set):
+    """Drop build/cache entries whose key is not in keep."""
+    try:
+        entries = list((BUILD / "cache").iterdir())
+    except OSError:
+        return
+    for p in entries:
+        if p.name.split(".", 1)[0] not in keep:
+            p.unlink()
+
+
+def compile_objects(cc: List[str], jobs: List[Tuple[Path, Path]],
+                    generated: Tuple[Path, ...] = ()) -> Dict[str, List[str]]:
+    """Compile each (src, obj) pair with up to cpu_count() cc processes.
+
+    Sources listed in generated are ours, so they also get the precompiled
+    header.
+
+    Without ccache, objects are reused from build/cache/<hash>.o as long as
+    the source and every header it included still hash the same; entries
+    not used by a successful batch are pruned. Returns the dependency list
+    of every object, keyed by object path.
+    """
+    pch_flags = _ensure_pch(cc) if generated else []
+    # Let ccache cache TUs that pull in the precompiled header.
+    pch_env = _ccache_env(cc[0]) if pch_flags and len(cc) > 1 else None
+    deps: Dict[str, List[str]] = {}
+    keys = set()
+    pending = collections.deque()
+    for src, obj in jobs:
+        pch = src in generated
+        cflags = [*CFLAGS, *pch_flags] if pch else CFLAGS
+        key = None if len(cc) > 1 else _cache_key(cc, cflags, src)
+        if key:
+            keys.add(key)
+        hit = _cache_fetch(key, obj) if key else None
+        if hit is None:
+            pending.append((src, obj, key, cflags, pch_env if pch else None))
+        else:
+            deps[str(obj)] = hit
+
+    limit = os.cpu_count() or 1
+    running: Dict[int, tuple] = {}
+    try:
+        while pending or running:
+            while pending and len(running) < limit:
+                src, obj, key, cflags, env = pending.popleft()
+                proc = subprocess.Popen(_compile_cmd(cc, cflags, src, obj), env=env)
+                running[proc.pid] = (proc, obj, key)
+            pid, status = os.wait()
+            if pid not in running:
+                continue
+            proc, obj, key = running.pop(pid)
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            if proc.returncode:
+                raise subprocess.CalledProcessError(proc.returncode, proc.args)
+            deps[str(obj)] = parse_depfile(_depfile(obj))
+            if key:
+                _cache_store(key, obj, deps[str(obj)])
+    finally:
+        # On failure or interrupt, stop the compiles still in flight.
+        for proc, _, _ in running.values():
+            proc.kill()
+            proc.wait()
+    if keys:
+        _prune_cache(keys)
+    return deps
+
+
+def load_manifest() -> dict:
+    try:
+        return json.loads(MANIFEST.read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def _current_state(cc: List[str], tools: List[str],
+                   deps: Dict[str, List[str]], prior: dict) -> dict:
+    """Snapshot build inputs; hash only files whose mtime/size changed.
+
+    Covers every tool source plus each header recorded in deps.
+    """
+    prior_files = prior.get("files", {})
+    paths = [str(TOOLS / f"{t}.c") for t in tools]
+    paths += [d for obj_deps in deps.values() for d in obj_deps]
+    files = {}
+    for path in dict.fromkeys(paths):
+        try:
+            st = os.stat(path)
+        except OSError:
+            files[path] = None
+            continue
+        old = prior_files.get(path)
+        if old and old[:2] == [st.st_mtime_ns, st.st_size]:
+            digest = old[2]
+        else:
+            digest = file_sha256(Path(path))
+        files[path] = [st.st_mtime_ns, st.st_size, digest]
+    return {
+        "version": VERSION,
+        "cc": cc,
+        "cflags": CFLAGS,
+        "ldflags": find_ldflags(cc[-1]),
+        "files": files,
+        "deps": deps,
+    }
+
+
+def _same_inputs(a: dict, b: dict) -> bool:
+    """Compare two states by content, ignoring mtimes."""
+    def strip(state: dict) -> dict:
+        files = {p: v and v[2] for p, v in state.get("files", {}).items()}
+        return {**state, "files": files}
+    return strip(a) == strip(b)
+
+
+def _up_to_date(out: Path, state: dict, prior: dict) -> bool:
+    return out.exists() and _same_inputs(state, prior)
 
 
 # =============================
@@ -135,17 +484,32 @@ int {name}_main(int argc, char **argv) {{
 """
 
 
-def dispatcher_template(tools: List[str]) -> str:
-    decls = []
-    entries = []
-
-    for t in tools:
-        decls.append(f"int {t}_main(int, char**);")
-        decls.append(f"extern const char *{t}_desc __attribute__((weak));")
-        decls.append(f"extern const char *{t}_help __attribute__((weak));")
-        entries.append(f'    {{"{t}", {t}_main, &{t}_desc, &{t}_help}},')
-
-    return f"""
+def _prepare(tools_dir: Path) -> Tuple[List[str], str, str]:
+    """Discover valid tools and render their dispatcher snippets in one pass.
+
+    Returns the sorted tool names, the declarations block and the body of
+    the tools[] table.
+    """
+    match = TOOL_RE.match
+    decls = io.StringIO()
+    entries = io.StringIO()
+    tools = []
+    for p in sorted(tools_dir.glob("*.c")):
+        t = p.stem
+        if not match(t):
+            continue
+        decls.write(f"int {t}_main(int, char**);\n"
+                    f"extern const char *{t}_desc __attribute__((weak));\n"
+                    f"extern const char *{t}_help __attribute__((weak));\n")
+        entries.write(f'    {{"{t}", {t}_main, &{t}_desc, &{t}_help}},\n')
+        tools.append(t)
+    return tools, decls.getvalue(), entries.getvalue()
+
+
+def dispatcher_template(decls: str, entries: str) -> str:
+    buf = io.StringIO()
+    write = buf.write
+    write(f"""
 #include <stdio.h>
 #include <string.h>
 #include <libgen.h>
@@ -160,65 +524,66 @@ struct Tool {{
     const char **help;
 }};
 
-{chr(10).join(decls)}
+""")
+    write(decls)
+    write("\nstatic struct Tool tools[] = {\n")
+    write(entries)
+    write("""    {NULL,NULL,NULL,NULL}
+};
 
-static struct Tool tools[] = {{
-{chr(10).join(entries)}
-    {{NULL,NULL,NULL,NULL}}
-}};
-
-static void help() {{
+static void help() {
     printf("%s v%s\\n", APP, VER);
     printf("Usage: %s <cmd> [args]\\n\\n", APP);
-    for (int i=0; tools[i].name; i++) {{
+    for (int i=0; tools[i].name; i++) {
         const char *d = (tools[i].desc && *tools[i].desc) ? *tools[i].desc : "";
         printf("  %-16s %s\\n", tools[i].name, d);
-    }}
-}}
+    }
+}
 
-static void tool_help(const char *name) {{
-    for (int i=0; tools[i].name; i++) {{
-        if (!strcmp(name, tools[i].name)) {{
+static void tool_help(const char *name) {
+    for (int i=0; tools[i].name; i++) {
+        if (!strcmp(name, tools[i].name)) {
             if (tools[i].desc && *tools[i].desc)
                 printf("%s - %s\\n", name, *tools[i].desc);
-            if (tools[i].help && *tools[i].help) {{
+            if (tools[i].help && *tools[i].help) {
                 printf("%s\\n", *tools[i].help);
-            }} else {{
+            } else {
                 printf("Usage: %s [args]\\n", name);
-            }}
+            }
             return;
-        }}
-    }}
+        }
+    }
     printf("Unknown command: %s\\n", name);
-}}
+}
 
-static int dispatch(const char *name, int argc, char **argv) {{
-    if (argc > 1 && (!strcmp(argv[1], "--help") || !strcmp(argv[1], "-h"))) {{
+static int dispatch(const char *name, int argc, char **argv) {
+    if (argc > 1 && (!strcmp(argv[1], "--help") || !strcmp(argv[1], "-h"))) {
         tool_help(name);
         return 0;
-    }}
+    }
     for (int i=0; tools[i].name; i++)
         if (!strcmp(name, tools[i].name))
             return tools[i].fn(argc, argv);
     fprintf(stderr, "Unknown command: %s\\n", name);
     return 1;
-}}
+}
 
-int main(int argc, char **argv) {{
+int main(int argc, char **argv) {
     char *prog = basename(argv[0]);
 
-    if (argc > 1 && (!strcmp(argv[1], "--help") || !strcmp(argv[1], "-h"))) {{
+    if (argc > 1 && (!strcmp(argv[1], "--help") || !strcmp(argv[1], "-h"))) {
         help(); return 0;
-    }}
+    }
 
-    if (!strcmp(prog, APP)) {{
-        if (argc < 2) {{ help(); return 0; }}
+    if (!strcmp(prog, APP)) {
+        if (argc < 2) { help(); return 0; }
         return dispatch(argv[1], argc-1, argv+1);
-    }}
+    }
 
     return dispatch(prog, argc, argv);
-}}
-"""
+}
+""")
+    return buf.getvalue()
 
 
 # =============================
@@ -228,115 +593,213 @@ int main(int argc, char **argv) {{
 def cmd_create(name: str):
     name = validate_tool(name)
     path = TOOLS / f"{name}.c"
+    content = tool_template(name)
     if path.exists():
+        # Leave identical files alone so their mtime keeps builds up to date.
+        if path.read_bytes() == content.encode():
+            print("[=] unchanged", path)
+            return
         die("Tool already exists")
-    atomic_write(path, tool_template(name))
+    atomic_write(path, content)
     print("[+] Created", path)
 
 
+def build_objects(cc: List[str], tools: List[str], main_src: str, out: Path,
+                  prior_deps: Dict[str, List[str]]) -> Dict[str, List[str]]:
+    """Compile each TU to an object in parallel, then link once."""
+    obj_dir = BUILD / "obj"
+    obj_dir.mkdir(exist_ok=True)
+    main_o = BUILD / "main.o"
+    jobs = [(TOOLS / f"{t}.c", obj_dir / f"{t}.o") for t in tools]
+
+    # Reuse main.o while the rendered dispatcher and compiler are unchanged.
+    disp_key_path = BUILD / ".disp.key"
+    disp_key = hashlib.sha256(
+        (main_src + repr((compiler_id(cc), CFLAGS))).encode()
+    ).hexdigest()
+    try:
+        disp_fresh = disp_key_path.read_text() == disp_key and main_o.exists()
+    except OSError:
+        disp_fresh = False
+    if not disp_fresh:
+        # Drop the old key first so a failed build cannot pair it with a
+        # main.o that was already recompiled for a different tool set.
+        if disp_key_path.exists():
+            disp_key_path.unlink()
+        main_c = BUILD / "main.c"
+        atomic_write(main_c, main_src)
+        jobs.append((main_c, main_o))
+
+    deps = compile_objects(cc, jobs, () if disp_fresh else (main_c,))
+    if disp_fresh:
+        deps[str(main_o)] = prior_deps.get(str(main_o), [])
+    else:
+        atomic_write(disp_key_path, disp_key)
+
+    objs = [str(main_o), *(str(obj_dir / f"{t}.o") for t in tools)]
+    subprocess.check_call([cc[-1], "-o", str(out), *objs, *find_ldflags(cc[-1])])
+    return deps
+
+
+def build_amalgam(cc: List[str], tools: List[str], main_src: str, out: Path,
+                  quiet: bool = False) -> Dict[str, List[str]]:
+    """Compile and link every tool plus the dispatcher as one TU."""
+    amalgam_c = BUILD / "amalgam.c"
+    depfile = BUILD / "amalgam.d"
+    includes = "".join(f'#include "{TOOLS / t}.c"\n' for t in tools)
+    atomic_write(amalgam_c, includes + main_src)
+    subprocess.check_call(
+        [cc[-1], *CFLAGS, "-MMD", "-MP", "-MF", str(depfile),
+         "-o", str(out), str(amalgam_c), *find_ldflags(cc[-1])],
+        stderr=subprocess.DEVNULL if quiet else None,
+    )
+    return {str(amalgam_c): parse_depfile(depfile)}
+
+
+def link_tools(tools: List[str], out: Path):
+    """Point bin/<tool> and bin/<app> at out, touching only stale links."""
+    target = str(out)
+    for t in tools + [APP_NAME]:
+        link = BIN / t
+        try:
+            if os.readlink(link) == target:
+                continue
+        except OSError:
+            pass
+        if link.exists() or link.is_symlink():
+            link.unlink()
+        link.symlink_to(out)
+
+
 def cmd_build():
     cc = find_cc()
-    tools = list_tools()
+    tools, decls, entries = _prepare(TOOLS)
     if not tools:
         die("No tools to build")
 
-    main_c = BUILD / "main.c"
-    atomic_write(main_c, dispatcher_template(tools))
-
     out = BUILD / APP_NAME
-    cmd = [cc, *CFLAGS, "-o", str(out), str(main_c)]
-    cmd += [str(TOOLS / f"{t}.c") for t in tools]
-    cmd += LDFLAGS
+    prior = load_manifest()
+    prior_deps = prior.get("deps", {})
+    state = _current_state(cc, tools, prior_deps, prior)
+    if _up_to_date(out, state, prior):
+        if state != prior:
+            atomic_write(MANIFEST, json.dumps(state))
+        link_tools(tools, out)
+        print("[=] up to date")
+        return
 
     print("[*] Building...")
-    subprocess.check_call(cmd)
+    main_src = dispatcher_template(decls, entries)
+    mode = os.environ.get("TOOLBOX_AMALGAM", "auto")
+    if mode == "1":
+        deps = build_amalgam(cc, tools, main_src, out)
+    elif mode == "auto" and len(tools) < AMALGAM_MAX_TOOLS:
+        try:
+            deps = build_amalgam(cc, tools, main_src, out, quiet=True)
+        except subprocess.CalledProcessError:
+            # Tools may clash once merged (e.g. same static helper names).
+            print("[*] Amalgamated build failed, compiling per TU")
+            deps = build_objects(cc, tools, main_src, out, prior_deps)
+    else:
+        deps = build_objects(cc, tools, main_src, out, prior_deps)
 
-    for t in tools + [APP_NAME]:
-        link = BIN / t
-        if link.exists():
-            link.unlink()
-        link.symlink_to(out)
+    link_tools(tools, out)
+    atomic_write(MANIFEST, json.dumps(_current_state(cc, tools, deps, state)))
 
     print("[+] Build complete")
     print(f"    Add to PATH: export PATH=\"{BIN}:$PATH\"")
 
 
-def menu_select() -> tuple[str, Optional[str]]:
+def menu_select(stdscr) -> tuple[str, Optional[str]]:
     import curses
 
-    def _menu(stdscr):
-        curses.curs_set(0)
-        options = ["Create tool", "Build", "List tools", "Exit"]
-        idx = 0
-        while True:
-            stdscr.clear()
-            stdscr.addstr(0, 2, "toolbox menu")
-            stdscr.addstr(1, 2, "Use arrows or j/k, Enter to select.")
-            for i, opt in enumerate(options):
-                if i == idx:
-                    stdscr.attron(curses.A_REVERSE)
-                stdscr.addstr(3 + i, 4, opt)
-                if i == idx:
-                    stdscr.attroff(curses.A_REVERSE)
-            key = stdscr.getch()
-            if key in (curses.KEY_UP, ord("k")):
-                idx = (idx - 1) % len(options)
-            elif key in (curses.KEY_DOWN, ord("j")):
-                idx = (idx + 1) % len(options)
-            elif key in (10, 13):
-                break
-        choice = options[idx]
-        if choice == "Create tool":
-            stdscr.clear()
-            stdscr.addstr(0, 2, "Enter tool name:")
-            stdscr.refresh()
-            curses.echo()
-            name = stdscr.getstr(2, 2, 64).decode("utf-8").strip()
-            curses.noecho()
-            return ("create", name if name else None)
-        if choice == "Build":
-            return ("build", None)
-        if choice == "List tools":
-            return ("list", None)
-        return ("exit", None)
-
-    return curses.wrapper(_menu)
-
-
-def cmd_menu():
+    options = ["Create tool", "Build", "List tools", "Exit"]
+    idx = 0
     while True:
+        stdscr.clear()
+        stdscr.addstr(0, 2, "toolbox menu")
+        stdscr.addstr(1, 2, "Use arrows or j/k, Enter to select.")
+        for i, opt in enumerate(options):
+            if i == idx:
+                stdscr.attron(curses.A_REVERSE)
+            stdscr.addstr(3 + i, 4, opt)
+            if i == idx:
+                stdscr.attroff(curses.A_REVERSE)
+        key = stdscr.getch()
+        if key in (curses.KEY_UP, ord("k")):
+            idx = (idx - 1) % len(options)
+        elif key in (curses.KEY_DOWN, ord("j")):
+            idx = (idx + 1) % len(options)
+        elif key in (10, 13):
+            break
+    choice = options[idx]
+    if choice == "Create tool":
+        stdscr.clear()
+        stdscr.addstr(0, 2, "Enter tool name:")
+        stdscr.refresh()
+        curses.echo()
+        name = stdscr.getstr(2, 2, 64).decode("utf-8").strip()
+        curses.noecho()
+        return ("create", name if name else None)
+    if choice == "Build":
+        return ("build", None)
+    if choice == "List tools":
+        return ("list", None)
+    return ("exit", None)
+
+
+def run_menu_action(action: str, name: Optional[str]):
+    if action == "create":
+        if not name:
+            print("No tool name provided.")
+        else:
+            try:
+                cmd_create(name)
+            except SystemExit as exc:
+                print(exc)
+    elif action == "build":
         try:
-            if sys.stdin.isatty():
-                term = os.environ.get("TERM")
-                if not term or term == "dumb":
-                    os.environ["TERM"] = "xterm-256color"
-            action, name = menu_select()
+            cmd_build()
         except Exception as exc:
-            print(f"TUI unavailable ({exc}), falling back to basic menu.")
-            return
+            print(exc)
+    elif action == "list":
+        tools = list_tools()
+        if tools:
+            print("Tools:", ", ".join(tools))
+        else:
+            print("No tools found.")
 
-        if action == "exit":
-            return
-        if action == "create":
-            if not name:
-                print("No tool name provided.")
-            else:
-                try:
-                    cmd_create(name)
-                except SystemExit as exc:
-                    print(exc)
-        elif action == "build":
+
+def cmd_menu():
+    def _session(stdscr):
+        curses.curs_set(0)
+        while True:
+            action, name = menu_select(stdscr)
+            if action == "exit":
+                return
+            # Drop to the normal terminal for command output, then resume
+            # the same curses session rather than re-initialising it.
+            curses.def_prog_mode()
+            curses.endwin()
             try:
-                cmd_build()
+                run_menu_action(action, name)
             except Exception as exc:
-                print(exc)
-        elif action == "list":
-            tools = list_tools()
-            if tools:
-                print("Tools:", ", ".join(tools))
-            else:
-                print("No tools found.")
-        input("Press Enter to continue...")
+                # Report action failures and stay in the menu; only
+                # curses set-up errors should end the TUI.
+                print(f"[!] {exc}")
+            input("Press Enter to continue...")
+            curses.reset_prog_mode()
+            stdscr.refresh()
+
+    try:
+        import curses
+        if sys.stdin.isatty():
+            term = os.environ.get("TERM")
+            if not term or term == "dumb":
+                os.environ["TERM"] = "xterm-256color"
+        curses.wrapper(_session)
+    except Exception as exc:
+        print(f"TUI unavailable ({exc}), falling back to basic menu.")
 
 
 # =============================